@@ -1,8 +1,11 @@
+import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from typing import List
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-from .search_engine import SearchEngine
+from .search_engine import SearchEngine, set_faiss_threads
 
 # ------------- Config -------------
 DOCS_FOLDER = os.getenv("DOCS_FOLDER", "data/docs")
@@ -10,6 +13,29 @@ DOCS_FOLDER = os.getenv("DOCS_FOLDER", "data/docs")
 # Global engine instance
 engine = None
 
+# Worker threads for blocking search calls (encoder and FAISS release the GIL).
+# Each worker runs FAISS with THREADS_PER_CALL threads so that
+# SEARCH_WORKERS * THREADS_PER_CALL stays around the core count. The FAISS
+# thread count is per thread, so it is set in each worker rather than
+# globally; startup and /rebuild keep every core for encoding and training.
+CPU_COUNT = os.cpu_count() or 1
+SEARCH_WORKERS = max(1, min(int(os.getenv("SEARCH_WORKERS", "4")), CPU_COUNT))
+THREADS_PER_CALL = max(1, CPU_COUNT // SEARCH_WORKERS)
+EXEC = ThreadPoolExecutor(
+    max_workers=SEARCH_WORKERS,
+    initializer=set_faiss_threads,
+    initargs=(THREADS_PER_CALL,),
+)
+# Rebuilds get their own single worker so they never run concurrently with
+# each other or tie up the search pool
+REBUILD_EXEC = ThreadPoolExecutor(max_workers=1)
+
+
+async def run_blocking(fn, *args, executor=EXEC, **kwargs):
+    """Run a blocking engine call on an executor without stalling the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, lambda: fn(*args, **kwargs))
+
 # ------------- Lifespan Events -------------
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -47,6 +73,8 @@ async def lifespan(app: FastAPI):
             engine.cache.close()
         except:
             pass
+    EXEC.shutdown(wait=False)
+    REBUILD_EXEC.shutdown(wait=False)
     print("Shutting down...")
 
 # ------------- API App -------------
@@ -65,7 +93,7 @@ class SearchRequest(BaseModel):
 
 # ------------- Routes -------------
 @app.get("/")
-def root():
+async def root():
     """Root endpoint with API information."""
     return {
         "name": "Lightweight Embedding Search Engine API",
@@ -74,6 +102,7 @@ def root():
         "endpoints": {
             "health": "/health",
             "search": "/search (POST)",
+            "search_batch": "/search_batch (POST)",
             "docs_count": "/docs/count",
             "rebuild": "/rebuild (POST)",
             "api_docs": "/docs",
@@ -83,7 +112,7 @@ def root():
     }
 
 @app.get("/health")
-def health_check():
+async def health_check():
     if engine is None:
         raise HTTPException(status_code=503, detail="Search engine not initialized")
     return {
@@ -93,7 +122,7 @@ def health_check():
     }
 
 @app.post("/search")
-def search(request: SearchRequest):
+async def search(request: SearchRequest):
     """
     Search for documents similar to the query.
     """
@@ -107,7 +136,7 @@ def search(request: SearchRequest):
         raise HTTPException(status_code=400, detail="top_k must be at least 1")
     
     try:
-        results = engine.search(request.query, top_k=request.top_k)
+        results = await run_blocking(engine.search, request.query, top_k=request.top_k)
         return {
             "query": request.query,
             "top_k": request.top_k,
@@ -117,8 +146,40 @@ def search(request: SearchRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Search error: {str(e)}")
 
+@app.post("/search_batch")
+async def search_batch(requests: List[SearchRequest]):
+    """
+    Search for several queries in one pass over the index.
+    """
+    if engine is None:
+        raise HTTPException(status_code=503, detail="Search engine not initialized")
+    
+    if not requests:
+        raise HTTPException(status_code=400, detail="At least one query is required")
+    
+    for request in requests:
+        if not request.query.strip():
+            raise HTTPException(status_code=400, detail="Query cannot be empty")
+        if request.top_k < 1:
+            raise HTTPException(status_code=400, detail="top_k must be at least 1")
+    
+    try:
+        max_k = max(r.top_k for r in requests)
+        batch = await run_blocking(engine.search_batch, [r.query for r in requests], top_k=max_k)
+        return [
+            {
+                "query": request.query,
+                "top_k": request.top_k,
+                "results": results[:request.top_k],
+                "count": len(results[:request.top_k])
+            }
+            for request, results in zip(requests, batch)
+        ]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Search error: {str(e)}")
+
 @app.get("/docs/count")
-def get_doc_count():
+async def get_doc_count():
     """Get the number of documents in the index."""
     if engine is None:
         raise HTTPException(status_code=503, detail="Search engine not initialized")
@@ -128,14 +189,14 @@ def get_doc_count():
     }
 
 @app.post("/rebuild")
-def rebuild_index(force_recompute: bool = False):
+async def rebuild_index(force_recompute: bool = False):
     """
     Rebuild the search index.
     """
     if engine is None:
         raise HTTPException(status_code=503, detail="Search engine not initialized")
     try:
-        engine.build_index(force_recompute=force_recompute)
+        await run_blocking(engine.build_index, executor=REBUILD_EXEC, force_recompute=force_recompute)
         return {
             "status": "Index rebuilt successfully",
             "docs_indexed": len(engine.doc_ids) if engine.doc_ids else 0
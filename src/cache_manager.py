@@ -1,11 +1,26 @@
 import sqlite3
 import pickle
 import os
-from typing import Optional
+from typing import Dict, List, Optional
 
-from .utils import now_iso
+import numpy as np
+
+from .utils import HASH_ALGO, PIPELINE_ID, now_iso
 
 DB_PATH = os.getenv("EMB_CACHE_DB", "embeddings_cache.db")
+# stay under SQLITE_MAX_VARIABLE_NUMBER (999 on older builds)
+IN_CHUNK_SIZE = 900
+# v0: pickled embeddings, v1: raw float32 bytes, v2: float32 + L2-normalized,
+# v3: hash_algo column, v4: source file mtime/size columns,
+# v5: text-pipeline tag on processed rows
+SCHEMA_VERSION = 5
+
+def _to_blob(embedding) -> bytes:
+    return np.ascontiguousarray(embedding, dtype=np.float32).tobytes()
+
+
+def _from_blob(emb_blob: bytes) -> np.ndarray:
+    return np.frombuffer(emb_blob, dtype=np.float32)
 
 
 class CacheManager:
@@ -13,9 +28,30 @@ class CacheManager:
         self.db_path = db_path
         self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
         self._init_db()
+        # doc_id -> (hash, hash_algo, mtime, size), kept in sync on writes so
+        # freshness checks never touch SQLite
+        cur = self._conn.cursor()
+        self._hash_index = {
+            doc_id: (hashv, hash_algo, mtime, size)
+            for doc_id, hashv, hash_algo, mtime, size in cur.execute("SELECT doc_id, hash, hash_algo, mtime, size FROM embeddings")
+        }
+        # global token vocabulary for packed token blobs in `processed`; ids
+        # are assigned by SQLite so several managers can share one DB
+        self._vocab = {}  # token -> id
+        self._vocab_tokens = {}  # id -> token
+        for tid, token in cur.execute("SELECT id, token FROM vocab"):
+            self._vocab[token] = tid
+            self._vocab_tokens[tid] = token
 
     def _init_db(self):
         cur = self._conn.cursor()
+        # WAL + NORMAL sync: one fsync per transaction instead of per write,
+        # and readers don't block on a writer
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA mmap_size=268435456")
+        cur.execute("PRAGMA cache_size=-65536")
         cur.execute(
             """
             CREATE TABLE IF NOT EXISTS embeddings (
@@ -23,42 +59,273 @@ class CacheManager:
                 filename TEXT,
                 hash TEXT,
                 embedding BLOB,
-                updated_at TEXT
+                updated_at TEXT,
+                hash_algo TEXT,
+                mtime INTEGER,
+                size INTEGER
+            )
+            """
+        )
+        # per-file text pipeline output (cleaned text, token ids, content hash)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS processed (
+                doc_id TEXT PRIMARY KEY,
+                mtime INTEGER,
+                size INTEGER,
+                cleaned TEXT,
+                tokens BLOB,
+                hash TEXT,
+                pipeline TEXT
             )
             """
         )
+        cur.execute("CREATE TABLE IF NOT EXISTS vocab (id INTEGER PRIMARY KEY, token TEXT UNIQUE)")
         self._conn.commit()
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            self._migrate(version)
+            cur.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self._conn.commit()
+
+    def _migrate(self, version: int):
+        """
+        Bring caches written by older versions up to SCHEMA_VERSION.
+        """
+        cur = self._conn.cursor()
+        if version < 2:
+            # rewrite embeddings as L2-normalized float32 bytes
+            cur.execute("SELECT doc_id, embedding FROM embeddings")
+            rows = []
+            for doc_id, emb_blob in cur.fetchall():
+                emb = pickle.loads(emb_blob) if version < 1 else _from_blob(emb_blob)
+                emb = np.asarray(emb, dtype=np.float32)
+                norm = np.linalg.norm(emb)
+                if norm > 0:
+                    emb = emb / norm
+                rows.append((_to_blob(emb), doc_id))
+            if rows:
+                with self._conn:
+                    self._conn.executemany("UPDATE embeddings SET embedding=? WHERE doc_id=?", rows)
+        if version < 3:
+            # existing rows were hashed with SHA-256
+            columns = {row[1] for row in cur.execute("PRAGMA table_info(embeddings)")}
+            if "hash_algo" not in columns:
+                cur.execute("ALTER TABLE embeddings ADD COLUMN hash_algo TEXT DEFAULT 'sha256'")
+                self._conn.commit()
+        if version < 4:
+            # NULL mtime/size means "unknown": such rows fall back to hashing
+            columns = {row[1] for row in cur.execute("PRAGMA table_info(embeddings)")}
+            if "mtime" not in columns:
+                cur.execute("ALTER TABLE embeddings ADD COLUMN mtime INTEGER")
+                cur.execute("ALTER TABLE embeddings ADD COLUMN size INTEGER")
+                self._conn.commit()
+        if version < 5:
+            # untagged rows came from an unknown pipeline and are never reused
+            columns = {row[1] for row in cur.execute("PRAGMA table_info(processed)")}
+            if "pipeline" not in columns:
+                cur.execute("ALTER TABLE processed ADD COLUMN pipeline TEXT")
+                self._conn.commit()
+
+    def has_fresh(self, doc_id: str, hashv: str) -> bool:
+        """
+        True if the cached embedding for doc_id was computed from content with this hash.
+        """
+        entry = self._hash_index.get(doc_id)
+        return entry is not None and entry[0] == hashv and entry[1] == HASH_ALGO
+
+    def get_meta(self, doc_id: str) -> Optional[dict]:
+        """
+        Cached hash and file stats for doc_id, served from memory.
+        """
+        entry = self._hash_index.get(doc_id)
+        if entry is None:
+            return None
+        hashv, hash_algo, mtime, size = entry
+        return {"doc_id": doc_id, "hash": hashv, "hash_algo": hash_algo, "mtime": mtime, "size": size}
 
     def get(self, doc_id: str) -> Optional[dict]:
         cur = self._conn.cursor()
-        cur.execute("SELECT filename, hash, embedding, updated_at FROM embeddings WHERE doc_id=?", (doc_id,))
+        cur.execute("SELECT filename, hash, embedding, updated_at, hash_algo, mtime, size FROM embeddings WHERE doc_id=?", (doc_id,))
         row = cur.fetchone()
         if not row:
             return None
-        filename, hashv, emb_blob, updated_at = row
-        embedding = pickle.loads(emb_blob)
-        return {"doc_id": doc_id, "filename": filename, "hash": hashv, "embedding": embedding, "updated_at": updated_at}
+        filename, hashv, emb_blob, updated_at, hash_algo, mtime, size = row
+        embedding = _from_blob(emb_blob)
+        return {
+            "doc_id": doc_id,
+            "filename": filename,
+            "hash": hashv,
+            "embedding": embedding,
+            "updated_at": updated_at,
+            "hash_algo": hash_algo,
+            "mtime": mtime,
+            "size": size,
+        }
+
+    def get_many(self, doc_ids: List[str]) -> Dict[str, dict]:
+        """
+        Fetch cached rows for many doc_ids in as few queries as possible.
+        Missing ids are simply absent from the returned dict.
+        """
+        out = {}
+        cur = self._conn.cursor()
+        for start in range(0, len(doc_ids), IN_CHUNK_SIZE):
+            chunk = doc_ids[start:start + IN_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            cur.execute(
+                f"SELECT doc_id, filename, hash, embedding, updated_at, hash_algo, mtime, size FROM embeddings WHERE doc_id IN ({placeholders})",
+                chunk,
+            )
+            for doc_id, filename, hashv, emb_blob, updated_at, hash_algo, mtime, size in cur.fetchall():
+                out[doc_id] = {
+                    "doc_id": doc_id,
+                    "filename": filename,
+                    "hash": hashv,
+                    "embedding": _from_blob(emb_blob),
+                    "updated_at": updated_at,
+                    "hash_algo": hash_algo,
+                    "mtime": mtime,
+                    "size": size,
+                }
+        return out
 
-    def upsert(self, doc_id: str, filename: str, hashv: str, embedding) -> None:
+    def upsert(self, doc_id: str, filename: str, hashv: str, embedding, mtime: Optional[int] = None, size: Optional[int] = None) -> None:
         cur = self._conn.cursor()
-        emb_blob = pickle.dumps(embedding)
+        emb_blob = _to_blob(embedding)
         cur.execute(
-            "INSERT OR REPLACE INTO embeddings (doc_id, filename, hash, embedding, updated_at) VALUES (?,?,?,?,?)",
-            (doc_id, filename, hashv, emb_blob, now_iso()),
+            "INSERT OR REPLACE INTO embeddings (doc_id, filename, hash, embedding, updated_at, hash_algo, mtime, size) VALUES (?,?,?,?,?,?,?,?)",
+            (doc_id, filename, hashv, emb_blob, now_iso(), HASH_ALGO, mtime, size),
         )
         self._conn.commit()
+        self._hash_index[doc_id] = (hashv, HASH_ALGO, mtime, size)
+
+    def upsert_many(self, items) -> None:
+        """
+        Insert or replace many (doc_id, filename, hash, embedding, mtime, size)
+        tuples inside a single transaction.
+        """
+        now = now_iso()
+        rows = [
+            (doc_id, filename, hashv, _to_blob(embedding), now, HASH_ALGO, mtime, size)
+            for doc_id, filename, hashv, embedding, mtime, size in items
+        ]
+        if not rows:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (doc_id, filename, hash, embedding, updated_at, hash_algo, mtime, size) VALUES (?,?,?,?,?,?,?,?)",
+                rows,
+            )
+        for doc_id, _, hashv, _, _, hash_algo, mtime, size in rows:
+            self._hash_index[doc_id] = (hashv, hash_algo, mtime, size)
+
+    def touch_many(self, items) -> None:
+        """
+        Update hash and file stats for (doc_id, hash, mtime, size) tuples whose
+        embedding is still valid, without rewriting the embedding.
+        """
+        now = now_iso()
+        rows = [(hashv, HASH_ALGO, mtime, size, now, doc_id) for doc_id, hashv, mtime, size in items]
+        if not rows:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE embeddings SET hash=?, hash_algo=?, mtime=?, size=?, updated_at=? WHERE doc_id=?",
+                rows,
+            )
+        for hashv, hash_algo, mtime, size, _, doc_id in rows:
+            if doc_id in self._hash_index:
+                self._hash_index[doc_id] = (hashv, hash_algo, mtime, size)
+
+    def get_processed_many(self, doc_ids: List[str]) -> Dict[str, dict]:
+        """
+        Fetch cached text-pipeline output for many doc_ids. Tokens come back
+        as a frozenset of strings. Rows written by a different pipeline
+        (PIPELINE_ID) are treated as missing.
+        """
+        out = {}
+        cur = self._conn.cursor()
+        for start in range(0, len(doc_ids), IN_CHUNK_SIZE):
+            chunk = doc_ids[start:start + IN_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            cur.execute(
+                f"SELECT doc_id, mtime, size, cleaned, tokens, hash FROM processed WHERE pipeline=? AND doc_id IN ({placeholders})",
+                [PIPELINE_ID, *chunk],
+            )
+            for doc_id, mtime, size, cleaned, tok_blob, hashv in cur.fetchall():
+                out[doc_id] = {
+                    "doc_id": doc_id,
+                    "mtime": mtime,
+                    "size": size,
+                    "cleaned": cleaned,
+                    "tokens": self._decode_tokens(tok_blob),
+                    "hash": hashv,
+                }
+        return out
+
+    def _decode_tokens(self, tok_blob: bytes) -> frozenset:
+        ids = np.frombuffer(tok_blob, dtype=np.uint32).tolist()
+        missing = [i for i in ids if i not in self._vocab_tokens]
+        if missing:
+            # ids added by another manager sharing this DB
+            for tid, token in self._select_vocab("id", missing):
+                self._vocab[token] = tid
+                self._vocab_tokens[tid] = token
+        return frozenset(self._vocab_tokens[i] for i in ids)
+
+    def _select_vocab(self, column: str, values) -> List[tuple]:
+        out = []
+        cur = self._conn.cursor()
+        values = list(values)
+        for start in range(0, len(values), IN_CHUNK_SIZE):
+            chunk = values[start:start + IN_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            cur.execute(f"SELECT id, token FROM vocab WHERE {column} IN ({placeholders})", chunk)
+            out.extend(cur.fetchall())
+        return out
+
+    def upsert_processed_many(self, items) -> None:
+        """
+        Insert or replace many (doc_id, mtime, size, cleaned, tokens, hash)
+        tuples inside a single transaction. Tokens are stored as packed uint32
+        ids into the vocab table.
+        """
+        if not items:
+            return
+        unknown = sorted({token for item in items for token in item[4]} - self._vocab.keys())
+        fetched = {}
+        with self._conn:
+            if unknown:
+                self._conn.executemany("INSERT OR IGNORE INTO vocab (token) VALUES (?)", [(t,) for t in unknown])
+                fetched = {token: tid for tid, token in self._select_vocab("token", unknown)}
+            rows = []
+            for doc_id, mtime, size, cleaned, tokens, hashv in items:
+                ids = [self._vocab.get(token, fetched.get(token)) for token in sorted(tokens)]
+                rows.append((doc_id, mtime, size, cleaned, np.asarray(ids, dtype=np.uint32).tobytes(), hashv, PIPELINE_ID))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO processed (doc_id, mtime, size, cleaned, tokens, hash, pipeline) VALUES (?,?,?,?,?,?,?)",
+                rows,
+            )
+        # only remember new ids once they are committed
+        for token, tid in fetched.items():
+            self._vocab[token] = tid
+            self._vocab_tokens[tid] = token
 
     def all(self):
         cur = self._conn.cursor()
-        cur.execute("SELECT doc_id, filename, hash, embedding, updated_at FROM embeddings")
+        cur.execute("SELECT doc_id, filename, hash, embedding, updated_at, hash_algo, mtime, size FROM embeddings")
         out = []
-        for doc_id, filename, hashv, emb_blob, updated_at in cur.fetchall():
+        for doc_id, filename, hashv, emb_blob, updated_at, hash_algo, mtime, size in cur.fetchall():
             out.append({
                 "doc_id": doc_id,
                 "filename": filename,
                 "hash": hashv,
-                "embedding": pickle.loads(emb_blob),
+                "embedding": _from_blob(emb_blob),
                 "updated_at": updated_at,
+                "hash_algo": hash_algo,
+                "mtime": mtime,
+                "size": size,
             })
         return out
 
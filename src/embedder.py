@@ -1,57 +1,89 @@
+import os
 import torch
-import hashlib
 import numpy as np
 from sentence_transformers import SentenceTransformer
 
+from .utils import content_hash
+
 
 class Embedder:
-    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2"):
+    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2", num_threads: int = None):
         """
-        Load embedding model (GPU if available)
+        Load embedding model (GPU if available). num_threads caps torch's
+        intra-op threads on CPU (default: all cores).
         """
         device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"Loading embedding model on {device}...")
         self.device = device
         self.model = SentenceTransformer(model_name, device=device)
+        # fused attention kernels via optimum, if installed
+        try:
+            from optimum.bettertransformer import BetterTransformer
+            transformer = self.model[0]
+            transformer.auto_model = BetterTransformer.transform(transformer.auto_model)
+        except Exception:
+            pass
+        if device == "cuda":
+            self.model.half()
+            self.batch_size = 128
+        else:
+            torch.set_num_threads(num_threads or os.cpu_count() or 1)
+            self.batch_size = 32
 
     @staticmethod
     def compute_hash(text: str) -> str:
         """
-        Generate a SHA256 hash for caching document states.
+        Generate a content hash (xxh3-128) for caching document states.
         """
-        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return content_hash(text)
 
     def get_embedding(self, text: str):
         """
         Compute embedding vector for a single text string.
+        Returns float32 numpy array.
         """
         if not text.strip():
             return None
-        return self.model.encode(text, show_progress_bar=False).tolist()
+        # the CUDA model runs in fp16; callers always get float32
+        return self.model.encode(text, show_progress_bar=False).astype(np.float32, copy=False)
 
     def get_embeddings_batch(self, texts: list):
         """
         Compute embeddings for batch inputs.
+        Returns float32 numpy array of shape (len(texts), dim).
         """
         if not texts:
             return []
-        return self.model.encode(texts, show_progress_bar=True).tolist()
+        embs = self.model.encode(texts, batch_size=self.batch_size, show_progress_bar=True)
+        return embs.astype(np.float32, copy=False)
 
-    def embed_one(self, text: str):
+    def embed_one(self, text: str, normalize_embeddings: bool = True):
         """
         Alias for get_embedding - compute embedding for a single text.
-        Returns numpy array.
+        Returns float32 numpy array (unit-length unless normalize_embeddings=False).
         """
         if not text.strip():
-            return np.zeros(self.model.get_sentence_embedding_dimension())
-        return self.model.encode(text, show_progress_bar=False)
+            return np.zeros(self.model.get_sentence_embedding_dimension(), dtype=np.float32)
+        emb = self.model.encode(text, show_progress_bar=False, normalize_embeddings=normalize_embeddings)
+        return emb.astype(np.float32, copy=False)
 
-    def embed(self, texts: list):
+    def embed(self, texts: list, normalize_embeddings: bool = True, show_progress_bar: bool = True):
         """
         Alias for get_embeddings_batch - compute embeddings for batch.
-        Returns list of numpy arrays.
+        Returns float32 numpy array of shape (len(texts), dim), rows unit-length
+        unless normalize_embeddings=False.
+
+        SentenceTransformer.encode already sorts inputs by length before
+        batching and restores the original order, so batches are padded only
+        to similar lengths; no extra reordering is needed here.
         """
         if not texts:
-            return []
-        embeddings = self.model.encode(texts, show_progress_bar=True)
-        return [emb for emb in embeddings]
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        embs = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            show_progress_bar=show_progress_bar,
+            convert_to_numpy=True,
+            normalize_embeddings=normalize_embeddings,
+        )
+        return embs.astype(np.float32, copy=False)
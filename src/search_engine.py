@@ -1,6 +1,11 @@
 import os
-import hashlib
+import json
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from tqdm import tqdm
 
 try:
     import faiss
@@ -11,107 +16,389 @@ except Exception:
 from typing import List
 from .cache_manager import CacheManager
 from .embedder import Embedder
-from .utils import clean_text, tokenize
+from .utils import clean_text, content_hash, sha256_text, tokenize, tokenize_query
+
+# corpus-size thresholds for picking a FAISS index type
+SQ_MAX_DOCS = 10_000
+HNSW_MAX_DOCS = 100_000
+IVF_SMALL_MAX_DOCS = 1_000_000
+IVF_TRAIN_SAMPLE = 262_144
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 16
+# docs per encode / cache-read / index-add step while building
+BUILD_CHUNK = 512
+ADD_CHUNK = 65_536
+
+# number of recent query embeddings kept in memory
+QUERY_CACHE_SIZE = 1024
+
+# memory-mapped copy of the last built embedding matrix, reused on restart
+INDEX_DIR = os.getenv("INDEX_DIR", "index_cache")
+EMB_SIDECAR = "embeddings.npy"
+META_SIDECAR = "doc_ids.json"
+INDEX_FILE = "index.faiss"
+INDEX_META = "index.json"
+
+
+def _read_and_process(path: str):
+    with open(path, 'r', encoding='utf-8', errors='ignore', buffering=1 << 20) as f:
+        raw = f.read()
+    cleaned = clean_text(raw)
+    return cleaned, frozenset(tokenize(cleaned)), content_hash(cleaned)
+
+
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k highest scores, best first. O(N) partition plus a sort
+    of only the k survivors instead of a full argsort.
+    """
+    if k < len(scores):
+        part = np.argpartition(-scores, k)[:k]
+        return part[np.argsort(-scores[part])]
+    return np.argsort(-scores)
+
+
+def _remove_if_exists(path: str) -> None:
+    # another worker process may have removed it already
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def set_faiss_threads(n: int):
+    """
+    Set FAISS's OpenMP thread count for the calling thread (libgomp keeps it
+    per thread), e.g. from a ThreadPoolExecutor initializer.
+    """
+    if FAISS_AVAILABLE:
+        faiss.omp_set_num_threads(n)
+
+
+def _set_search_params(idx) -> None:
+    # search-time knobs; not every index type has them
+    params = faiss.ParameterSpace()
+    for name, value in (("efSearch", HNSW_EF_SEARCH), ("nprobe", IVF_NPROBE)):
+        try:
+            params.set_index_parameter(idx, name, value)
+        except RuntimeError:
+            pass
 
 
 class SearchEngine:
-    def __init__(self, docs_folder: str = "data/docs", use_faiss: bool = True):
+    def __init__(self, docs_folder: str = "data/docs", use_faiss: bool = True, index_dir: str = INDEX_DIR, num_threads: int = None):
+        # num_threads: torch/FAISS threads for this thread and the encoder
+        # (default: all cores, which is what index builds want)
         self.docs_folder = docs_folder
+        self.index_dir = index_dir
         self.cache = CacheManager()
-        self.embedder = Embedder()
+        self.embedder = Embedder(num_threads=num_threads)
         self.doc_texts = {}  # doc_id -> cleaned text
         self.doc_meta = {}
+        self.doc_tokens = {}  # doc_id -> frozenset of tokens
         self.embeddings = None
         self.doc_ids = []
         self.index = None
+        # (embeddings, doc_ids, index) swapped in as one unit when a build
+        # finishes, so concurrent searches never see a half-built state
+        self._snapshot = (None, [], None)
+        self._q_cache = OrderedDict()  # query -> unit-norm float32 vector (LRU)
+        self._q_cache_lock = threading.Lock()
+        self._build_lock = threading.Lock()  # one build_index at a time
         self.use_faiss = use_faiss and FAISS_AVAILABLE
+        if self.use_faiss:
+            faiss.omp_set_num_threads(num_threads or os.cpu_count() or 1)
 
     def load_docs(self):
-        # load all .txt files
-        files = [f for f in os.listdir(self.docs_folder) if f.endswith('.txt')]
-        files.sort()
-        for fn in files:
-            path = os.path.join(self.docs_folder, fn)
-            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-                raw = f.read()
-            cleaned = clean_text(raw)
-            doc_id = os.path.splitext(fn)[0]
+        # load all .txt files; files unchanged since the last run (same mtime
+        # and size) reuse the cached cleaned text/tokens/hash, the rest are
+        # read and processed on a thread pool
+        with os.scandir(self.docs_folder) as it:
+            files = sorted(entry.name for entry in it if entry.name.endswith('.txt') and entry.is_file())
+        paths = [os.path.join(self.docs_folder, fn) for fn in files]
+        doc_ids = [os.path.splitext(fn)[0] for fn in files]
+        workers = min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            stats = list(ex.map(os.stat, paths))
+            processed = self.cache.get_processed_many(doc_ids)
+            stale = [
+                i for i, (doc_id, st) in enumerate(zip(doc_ids, stats))
+                if doc_id not in processed
+                or (processed[doc_id]['mtime'], processed[doc_id]['size']) != (st.st_mtime_ns, st.st_size)
+            ]
+            for i, result in zip(stale, ex.map(_read_and_process, [paths[i] for i in stale])):
+                cleaned, tokens, hashv = result
+                processed[doc_ids[i]] = {"cleaned": cleaned, "tokens": tokens, "hash": hashv}
+        self.cache.upsert_processed_many([
+            (doc_ids[i], stats[i].st_mtime_ns, stats[i].st_size,
+             processed[doc_ids[i]]['cleaned'], processed[doc_ids[i]]['tokens'], processed[doc_ids[i]]['hash'])
+            for i in stale
+        ])
+
+        for fn, doc_id, st in zip(files, doc_ids, stats):
+            row = processed[doc_id]
+            cleaned = row['cleaned']
             self.doc_texts[doc_id] = cleaned
-            self.doc_meta[doc_id] = {"filename": fn, "length": len(cleaned.split())}
+            self.doc_tokens[doc_id] = row['tokens']
+            self.doc_meta[doc_id] = {
+                "filename": fn,
+                "mtime": st.st_mtime_ns,
+                "size": st.st_size,
+                "hash": row['hash'],
+                # cleaned text is single-space separated, so this equals len(cleaned.split())
+                "length": cleaned.count(" ") + 1 if cleaned else 0,
+            }
         return list(self.doc_texts.keys())
 
     def build_index(self, force_recompute=False):
-        # iterate docs, get embeddings (cache-aware)
-        texts = []
-        doc_ids = []
-        for doc_id, text in self.doc_texts.items():
-            doc_ids.append(doc_id)
-            texts.append(text)
-
-        # check cache per doc
-        emb_list = []
+        with self._build_lock:
+            self._build_index(force_recompute)
+
+    def _build_index(self, force_recompute):
+        doc_ids = list(self.doc_texts.keys())
+
+        # check freshness against the cache's in-memory hash index (no SQLite reads)
+        hashes = []
+        fresh_idx = []
         to_compute = []
         to_compute_idx = []
+        touched = []
         for i, doc_id in enumerate(doc_ids):
-            cache_row = self.cache.get(doc_id)
-            current_hash = hashlib.sha256(self.doc_texts[doc_id].encode('utf-8')).hexdigest()
-            if cache_row and cache_row['hash'] == current_hash and not force_recompute:
-                emb_list.append(cache_row['embedding'])
+            cache_row = None if force_recompute else self.cache.get_meta(doc_id)
+            meta = self.doc_meta[doc_id]
+            if cache_row and cache_row['mtime'] is not None and (cache_row['mtime'], cache_row['size']) == (meta.get('mtime'), meta.get('size')):
+                # file untouched since it was cached: skip hashing entirely
+                hashes.append(cache_row['hash'])
+                fresh_idx.append(i)
+                continue
+            text = self.doc_texts[doc_id]
+            current_hash = meta.get('hash') or content_hash(text)
+            hashes.append(current_hash)
+            if cache_row and (
+                self.cache.has_fresh(doc_id, current_hash)
+                or (cache_row['hash_algo'] == 'sha256' and cache_row['hash'] == sha256_text(text))
+            ):
+                # content unchanged (possibly a legacy SHA-256 row): keep the
+                # embedding, refresh hash/mtime/size
+                fresh_idx.append(i)
+                touched.append((doc_id, current_hash, meta.get('mtime'), meta.get('size')))
             else:
-                # placeholder, will compute later
-                emb_list.append(None)
-                to_compute.append(self.doc_texts[doc_id])
+                # will compute later
+                to_compute.append(text)
                 to_compute_idx.append(i)
+        self.cache.touch_many(touched)
 
-        if to_compute:
-            computed = self.embedder.embed(to_compute)
-            for j, idx in enumerate(to_compute_idx):
-                emb_list[idx] = computed[j]
-                doc_id = doc_ids[idx]
-                self.cache.upsert(doc_id, self.doc_meta[doc_id]['filename'], hashlib.sha256(self.doc_texts[doc_id].encode('utf-8')).hexdigest(), computed[j])
-
-        embs = np.vstack([np.array(e, dtype=np.float32) for e in emb_list])
-        self.embeddings = embs
-        self.doc_ids = doc_ids
+        fingerprint = content_hash("\n".join(f"{doc_id}:{h}" for doc_id, h in zip(doc_ids, hashes)))
+        embs = None if to_compute else self._load_sidecar(fingerprint, len(doc_ids))
+        reused = embs is not None
+        if embs is None:
+            embs = self._stream_embeddings(doc_ids, hashes, fresh_idx, to_compute_idx, to_compute, fingerprint)
 
-        # build FAISS index or fallback
+        # embeddings arrive L2-normalized from the encoder (and cache), so
+        # inner product == cosine similarity
+        index = None
         if self.use_faiss:
-            # normalize for cosine similarity (inner product after L2 normalize)
-            faiss.normalize_L2(self.embeddings)
-            d = self.embeddings.shape[1]
-            idx = faiss.IndexFlatIP(d)
-            idx.add(self.embeddings)
-            self.index = idx
+            index = self._load_faiss_index(fingerprint, len(doc_ids)) if reused else None
+            if index is None:
+                index = self._build_faiss_index(embs)
+                self._save_faiss_index(index, fingerprint)
+
+        # publish only once everything is ready; searches read _snapshot
+        self._snapshot = (embs, doc_ids, index)
+        self.embeddings, self.doc_ids, self.index = embs, doc_ids, index
+
+    def _load_sidecar(self, fingerprint: str, n: int):
+        """
+        Memory-map the embedding matrix from the last build if it was built
+        from exactly the same (doc_id, hash) sequence, else return None.
+        """
+        emb_path = os.path.join(self.index_dir, EMB_SIDECAR)
+        meta_path = os.path.join(self.index_dir, META_SIDECAR)
+        if not (os.path.exists(emb_path) and os.path.exists(meta_path)):
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get("fingerprint") != fingerprint:
+                return None
+            embs = np.load(emb_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if embs.shape[0] != n or embs.dtype != np.float32:
+            return None
+        return embs
+
+    def _stream_embeddings(self, doc_ids, hashes, fresh_idx, to_compute_idx, to_compute, fingerprint):
+        """
+        Fill the embedding matrix chunk by chunk, from the cache for fresh docs
+        and the encoder for the rest, writing straight into the on-disk
+        sidecar so the full NxD array is never held in RAM. Returns a
+        read-only memory map of the result.
+        """
+        d = self.embedder.model.get_sentence_embedding_dimension()
+        n = len(doc_ids)
+        if n == 0:
+            return np.empty((0, d), dtype=np.float32)
+        os.makedirs(self.index_dir, exist_ok=True)
+        emb_path = os.path.join(self.index_dir, EMB_SIDECAR)
+        meta_path = os.path.join(self.index_dir, META_SIDECAR)
+        # drop the old fingerprint first so a crash mid-write can't pair it
+        # with a new matrix
+        _remove_if_exists(meta_path)
+        emb_tmp = self._temp_path(emb_path)
+        out = np.lib.format.open_memmap(emb_tmp, mode='w+', dtype=np.float32, shape=(n, d))
+        for start in range(0, len(fresh_idx), BUILD_CHUNK):
+            chunk = fresh_idx[start:start + BUILD_CHUNK]
+            rows = self.cache.get_many([doc_ids[i] for i in chunk])
+            for i in chunk:
+                out[i] = rows[doc_ids[i]]['embedding']
+        for start in tqdm(range(0, len(to_compute), BUILD_CHUNK), desc="Embedding", disable=not to_compute):
+            chunk = to_compute_idx[start:start + BUILD_CHUNK]
+            computed = self.embedder.embed(to_compute[start:start + BUILD_CHUNK], show_progress_bar=False)
+            out[chunk] = computed
+            new_rows = []
+            for j, idx in enumerate(chunk):
+                doc_id = doc_ids[idx]
+                meta = self.doc_meta[doc_id]
+                new_rows.append((doc_id, meta['filename'], hashes[idx], computed[j], meta.get('mtime'), meta.get('size')))
+            self.cache.upsert_many(new_rows)
+        out.flush()
+        del out
+        os.replace(emb_tmp, emb_path)
+        self._write_json(meta_path, {"fingerprint": fingerprint, "doc_ids": doc_ids})
+        return np.load(emb_path, mmap_mode='r')
+
+    def _build_faiss_index(self, embs: np.ndarray):
+        """
+        Exhaustive 8-bit scalar-quantized scan for small corpora, HNSW over
+        8-bit codes for mid-size, OPQ+IVF+PQ codes beyond ~100k docs.
+        """
+        n, d = embs.shape
+        if n == 0:
+            return faiss.IndexFlatIP(d)
+        if n < SQ_MAX_DOCS:
+            key = "SQ8"
+        elif n < HNSW_MAX_DOCS:
+            key = "HNSW32,SQ8"
+        elif n < IVF_SMALL_MAX_DOCS:
+            key = "OPQ32_128,IVF4096,PQ32"
         else:
-            # store normalized embeddings for cosine via numpy
-            norms = np.linalg.norm(self.embeddings, axis=1, keepdims=True)
-            norms[norms == 0] = 1e-9
-            self.embeddings = self.embeddings / norms
-            self.index = None
+            key = "OPQ32_128,IVF65536_HNSW32,PQ32"
+        idx = faiss.index_factory(d, key, faiss.METRIC_INNER_PRODUCT)
+        if not idx.is_trained:
+            sample = embs[np.sort(np.random.choice(n, min(n, IVF_TRAIN_SAMPLE), replace=False))]
+            idx.train(sample)
+        for start in range(0, n, ADD_CHUNK):
+            idx.add(np.ascontiguousarray(embs[start:start + ADD_CHUNK]))
+        _set_search_params(idx)
+        return idx
+
+    def _load_faiss_index(self, fingerprint: str, n: int):
+        """
+        Read the index saved by a previous build from the same inputs, else None.
+        """
+        index_path = os.path.join(self.index_dir, INDEX_FILE)
+        meta_path = os.path.join(self.index_dir, INDEX_META)
+        if not (os.path.exists(index_path) and os.path.exists(meta_path)):
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                if json.load(f).get("fingerprint") != fingerprint:
+                    return None
+            idx = faiss.read_index(index_path)
+        except (OSError, ValueError, RuntimeError):
+            return None
+        if idx.ntotal != n:
+            return None
+        _set_search_params(idx)
+        return idx
+
+    def _save_faiss_index(self, idx, fingerprint: str):
+        os.makedirs(self.index_dir, exist_ok=True)
+        index_path = os.path.join(self.index_dir, INDEX_FILE)
+        meta_path = os.path.join(self.index_dir, INDEX_META)
+        _remove_if_exists(meta_path)
+        index_tmp = self._temp_path(index_path)
+        faiss.write_index(idx, index_tmp)
+        os.replace(index_tmp, index_path)
+        self._write_json(meta_path, {"fingerprint": fingerprint})
+
+    def _temp_path(self, final_path: str) -> str:
+        """
+        Unique temp file next to final_path, so concurrent writers (other
+        threads or worker processes) never share one before os.replace.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_dir, prefix=os.path.basename(final_path) + ".", suffix=".tmp")
+        os.close(fd)
+        return tmp_path
+
+    def _write_json(self, path: str, payload: dict):
+        tmp_path = self._temp_path(path)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(payload, f)
+        os.replace(tmp_path, path)
 
     def search(self, query: str, top_k: int = 5) -> List[dict]:
-        q_emb = self.embedder.embed_one(query).astype('float32')
-        # normalize
+        return self.search_batch([query], top_k=top_k)[0]
+
+    def search_batch(self, queries: List[str], top_k: int = 5) -> List[List[dict]]:
+        """
+        Search several queries at once: one encoder batch and one index sweep
+        serve all of them. Returns one result list per query, in order.
+        """
+        if not queries:
+            return []
+        embeddings, doc_ids, index = self._snapshot
+        q_embs = self._embed_queries(queries)
         if self.use_faiss:
-            import faiss
-            q = q_emb / (np.linalg.norm(q_emb) + 1e-9)
-            D, I = self.index.search(np.expand_dims(q, axis=0), top_k)
-            scores = D[0].tolist()
-            idxs = I[0].tolist()
+            D, I = index.search(q_embs, top_k)
+            hits = [(I[r].tolist(), D[r].tolist()) for r in range(len(queries))]
         else:
-            q = q_emb / (np.linalg.norm(q_emb) + 1e-9)
-            sims = np.dot(self.embeddings, q)
-            idxs = list(np.argsort(-sims)[:top_k])
-            scores = [float(sims[i]) for i in idxs]
+            sims = q_embs @ embeddings.T
+            hits = []
+            for row in sims:
+                idxs = _top_k_indices(row, top_k)
+                hits.append((idxs.tolist(), row[idxs].tolist()))
+        return [self._format_results(q, doc_ids, idxs, scores) for q, (idxs, scores) in zip(queries, hits)]
+
+    def _embed_queries(self, queries: List[str]) -> np.ndarray:
+        """
+        Embed queries, reusing recently seen ones from the LRU cache and
+        encoding all misses in a single batch.
+        """
+        cached = {}
+        with self._q_cache_lock:
+            for q in queries:
+                if q in self._q_cache:
+                    self._q_cache.move_to_end(q)
+                    cached[q] = self._q_cache[q]
+        misses = list(dict.fromkeys(q for q in queries if q not in cached))
+        if misses:
+            computed = np.ascontiguousarray(self.embedder.embed(misses, show_progress_bar=False), dtype=np.float32)
+            computed.setflags(write=False)
+            with self._q_cache_lock:
+                for q, vec in zip(misses, computed):
+                    cached[q] = vec
+                    self._q_cache[q] = vec
+                    self._q_cache.move_to_end(q)
+                while len(self._q_cache) > QUERY_CACHE_SIZE:
+                    self._q_cache.popitem(last=False)
+        return np.stack([cached[q] for q in queries])
 
+    def _format_results(self, query: str, doc_ids: List[str], idxs, scores) -> List[dict]:
         results = []
-        q_tokens = set(tokenize(query))
+        q_tokens = tokenize_query(query)
         for i, s in zip(idxs, scores):
-            doc_id = self.doc_ids[i]
+            if i < 0:
+                # FAISS pads with -1 when fewer than top_k hits exist
+                continue
+            doc_id = doc_ids[i]
             text = self.doc_texts[doc_id]
             
             # Compute token overlap for match info
-            doc_tokens = set(tokenize(text))
+            doc_tokens = self.doc_tokens.get(doc_id)
+            if doc_tokens is None:
+                doc_tokens = frozenset(tokenize(text))
             overlap = q_tokens & doc_tokens
             overlap_ratio = len(overlap) / len(q_tokens) if q_tokens else 0
             
@@ -1,9 +1,11 @@
+import functools
 import hashlib
 import re
 from datetime import datetime
-from typing import List
+from typing import FrozenSet, List
 
 import nltk
+import xxhash
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
 
@@ -18,15 +20,26 @@ except Exception:
     nltk.download("stopwords")
 
 STOPWORDS = set(stopwords.words("english"))
-TOKEN_RE = re.compile(r"\b\w+\b")
+TOKEN_RE = re.compile(r"\w+")
+
+
+# any run of simple HTML tags and whitespace collapses to a single space
+CLEAN_RE = re.compile(r"(?:<[^>]+>|\s)+")
 
 
 def clean_text(text: str) -> str:
-    text = text.lower()
-    # remove simple HTML tags
-    text = re.sub(r"<[^>]+>", " ", text)
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
+    return CLEAN_RE.sub(" ", text.lower()).strip()
+
+
+# tag stored alongside cached hashes so older SHA-256 rows can be recognized
+HASH_ALGO = "xxh3_128"
+
+
+def content_hash(text: str) -> str:
+    """
+    Fast non-cryptographic hash used to detect document content changes.
+    """
+    return xxhash.xxh3_128_hexdigest(text.encode("utf-8"))
 
 
 def sha256_text(text: str) -> str:
@@ -40,5 +53,20 @@ def tokenize(text: str) -> List[str]:
     return [t for t in tokens if t not in STOPWORDS]
 
 
+@functools.lru_cache(maxsize=2048)
+def tokenize_query(text: str) -> FrozenSet[str]:
+    """
+    Token set for a search query, memoized since queries repeat. Documents
+    use tokenize() directly; their token sets are kept by the engine.
+    """
+    return frozenset(tokenize(text))
+
+
+# tag stored with cached clean_text/tokenize output; bump PIPELINE_VERSION
+# whenever either changes (a different stopword list changes it on its own)
+PIPELINE_VERSION = 1
+PIPELINE_ID = f"{PIPELINE_VERSION}:{content_hash(' '.join(sorted(STOPWORDS)))}"
+
+
 def now_iso():
     return datetime.now().isoformat() + "Z"
\ No newline at end of file
@@ -0,0 +1,76 @@
+import pickle
+import sqlite3
+
+import numpy as np
+import pytest
+
+from src.cache_manager import CacheManager
+from src.utils import sha256_text
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    """
+    A cache DB in the original format: pickled, unnormalized embeddings
+    hashed with SHA-256 and no schema version.
+    """
+    db_path = str(tmp_path / "cache.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        """
+        CREATE TABLE embeddings (
+            doc_id TEXT PRIMARY KEY,
+            filename TEXT,
+            hash TEXT,
+            embedding BLOB,
+            updated_at TEXT
+        )
+        """
+    )
+    rows = {
+        "a.txt": np.array([3.0, 4.0, 0.0], dtype=np.float32),
+        "b.txt": np.array([1.0, 1.0, 1.0, 1.0], dtype=np.float64),
+    }
+    for doc_id, emb in rows.items():
+        conn.execute(
+            "INSERT INTO embeddings VALUES (?,?,?,?,?)",
+            (doc_id, doc_id, sha256_text(doc_id), pickle.dumps(emb), "2024-01-01T00:00:00Z"),
+        )
+    conn.commit()
+    conn.close()
+    return db_path
+
+
+def test_baseline_rows_are_migrated(baseline_db):
+    cache = CacheManager(baseline_db)
+    try:
+        rows = cache.get_many(["a.txt", "b.txt"])
+        assert set(rows) == {"a.txt", "b.txt"}
+        for doc_id, row in rows.items():
+            emb = row["embedding"]
+            assert emb.dtype == np.float32
+            assert np.isclose(np.linalg.norm(emb), 1.0)
+            # old SHA-256 rows are kept but flagged for re-hashing
+            assert row["hash_algo"] == "sha256"
+            assert not cache.has_fresh(doc_id, row["hash"])
+        np.testing.assert_allclose(rows["a.txt"]["embedding"], [0.6, 0.8, 0.0], rtol=1e-6)
+    finally:
+        cache.close()
+
+
+@pytest.mark.parametrize("tokens", [frozenset({"alpha", "beta", "gamma"}), frozenset()])
+def test_processed_round_trip(tmp_path, tokens):
+    db_path = str(tmp_path / "cache.db")
+    cache = CacheManager(db_path)
+    cache.upsert_processed_many([("doc.txt", 123, 45, "cleaned text", tokens, "h")])
+    assert cache.get_processed_many(["doc.txt"])["doc.txt"]["tokens"] == tokens
+    cache.close()
+
+    # a fresh manager resolves token ids from the stored vocab
+    cache = CacheManager(db_path)
+    try:
+        row = cache.get_processed_many(["doc.txt"])["doc.txt"]
+        assert row["tokens"] == tokens
+        assert (row["mtime"], row["size"], row["cleaned"], row["hash"]) == (123, 45, "cleaned text", "h")
+    finally:
+        cache.close()